@@ -1,9 +1,11 @@
 """Basic agent class. See https://mini-swe-agent.com/latest/advanced/control_flow/ for visual explanation."""
 
+import copy
 import fnmatch
 import re
 import subprocess
 import time
+from functools import cache
 
 from jinja2 import StrictUndefined, Template
 from pydantic import BaseModel
@@ -49,6 +51,12 @@ class LimitsExceeded(TerminatingException):
     """Raised when the agent has reached its cost or step limit."""
 
 
+@cache
+def _compile_template(template: str) -> Template:
+    """Compile a template once; the same few config templates are rendered at every step."""
+    return Template(template, undefined=StrictUndefined)
+
+
 class DefaultAgent:
     def __init__(self, model: Model, env: Environment, *, config_class: type = AgentConfig, **kwargs):
         self.config = config_class(**kwargs)
@@ -56,22 +64,58 @@ class DefaultAgent:
         self.model = model
         self.env = env
         self.extra_template_vars = {}
+        self._step_ts = time.time()  # shared by all messages added during one step
+        self._templates = {
+            name: Template(getattr(self.config, name), undefined=StrictUndefined)
+            for name in (
+                "system_template",
+                "instance_template",
+                "timeout_template",
+                "format_error_template",
+                "action_observation_template",
+            )
+        }
+        self._action_re = re.compile(self.config.action_regex, re.DOTALL)
+        self._source_path_res = [re.compile(fnmatch.translate(p)) for p in self.config.source_path_patterns]
+        self._config_state = None
+        self._static_template_vars = {}
 
     def render_template(self, template: str, **kwargs) -> str:
-        template_vars = self.config.model_dump() | self.env.get_template_vars() | self.model.get_template_vars()
-        return Template(template, undefined=StrictUndefined).render(
-            **kwargs, **template_vars, **self.extra_template_vars
-        )
+        """Render a template string, or one of the config templates by name (e.g. `"system_template"`)."""
+        compiled = self._templates.get(template) or _compile_template(template)
+        return compiled.render(**kwargs, **self.get_template_vars(), **self.extra_template_vars)
+
+    def get_template_vars(self) -> dict:
+        """Merged config, environment and model template variables.
+        The config and environment part is cached until the config changes (e.g. limits set by an interactive agent);
+        the model part changes with every query and is merged in fresh.
+        """
+        if vars(self.config) != self._config_state:
+            self._static_template_vars = self.config.model_dump() | self.env.get_template_vars()
+            self._config_state = copy.deepcopy(vars(self.config))
+        return self._static_template_vars | self.model.get_template_vars()
+
+    def _render_observation(self, output: dict) -> str:
+        """Fast path for the action observation, which is rendered at every step.
+        Passes the template variables as a mapping instead of re-merging them as keyword arguments.
+        """
+        template_vars = self.get_template_vars()
+        extra = self.extra_template_vars
+        if "output" in template_vars or "output" in extra or not template_vars.keys().isdisjoint(extra):
+            # Let render_template raise on the duplicate variable like for every other template
+            return self.render_template("action_observation_template", output=output)
+        return self._templates["action_observation_template"].render(template_vars, **extra, output=output)
 
     def add_message(self, role: str, content: str, **kwargs):
-        self.messages.append({"role": role, "content": content, "timestamp": time.time(), **kwargs})
+        self.messages.append({"role": role, "content": content, "timestamp": self._step_ts, **kwargs})
 
     def run(self, task: str, **kwargs) -> tuple[str, str]:
         """Run step() until agent is finished. Return exit status & message"""
         self.extra_template_vars |= {"task": task, **kwargs}
         self.messages = []
-        self.add_message("system", self.render_template(self.config.system_template))
-        self.add_message("user", self.render_template(self.config.instance_template))
+        self._step_ts = time.time()
+        self.add_message("system", self.render_template("system_template"))
+        self.add_message("user", self.render_template("instance_template"))
         while True:
             try:
                 self.step()
@@ -83,6 +127,7 @@ class DefaultAgent:
 
     def step(self) -> dict:
         """Query the LM, execute the action, return the observation."""
+        self._step_ts = time.time()
         return self.get_observation(self.query())
 
     def query(self) -> dict:
@@ -91,9 +136,8 @@ class DefaultAgent:
             raise LimitsExceeded()
         msgs = self.messages
         if self.config.max_history_messages > 0 and len(msgs) > 2:
-            head = msgs[:2]
-            tail = msgs[2:][-self.config.max_history_messages :]
-            msgs = head + tail
+            # Slice only the window: system + instance message, then the most recent messages
+            msgs = msgs[:2] + msgs[max(2, len(msgs) - self.config.max_history_messages) :]
         response = self.model.query(msgs)
         self.add_message("assistant", **response)
         return response
@@ -101,32 +145,33 @@ class DefaultAgent:
     def get_observation(self, response: dict) -> dict:
         """Execute the action and return the observation."""
         output = self.execute_action(self.parse_action(response))
-        observation = self.render_template(self.config.action_observation_template, output=output)
+        observation = self._render_observation(output)
         self.add_message("user", observation)
         return output
 
     def parse_action(self, response: dict) -> dict:
         """Parse the action from the message. Returns the action."""
-        actions = re.findall(self.config.action_regex, response["content"], re.DOTALL)
+        actions = self._action_re.findall(response["content"])
         if len(actions) == 1:
             return {"action": actions[0].strip(), **response}
-        raise FormatError(self.render_template(self.config.format_error_template, actions=actions))
+        raise FormatError(self.render_template("format_error_template", actions=actions))
 
     def execute_action(self, action: dict) -> dict:
         try:
             output = self.env.execute(action["action"])
         except (TimeoutError, subprocess.TimeoutExpired) as e:
             output = e.output.decode("utf-8", errors="replace") if getattr(e, "output", None) else ""
-            raise ExecutionTimeoutError(
-                self.render_template(self.config.timeout_template, action=action, output=output)
-            )
+            raise ExecutionTimeoutError(self.render_template("timeout_template", action=action, output=output))
         self.has_finished(output)
         return output | {"action": action["action"]}
 
     def has_finished(self, output: dict[str, str]):
         """Raises Submitted exception with final output if the agent has finished its task."""
-        lines = output.get("output", "").lstrip().splitlines(keepends=True)
-        if lines and lines[0].strip() in ["MINI_SWE_AGENT_FINAL_OUTPUT", "COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT"]:
+        text = output.get("output", "").lstrip()
+        if not text.startswith(("MINI_SWE_AGENT_FINAL_OUTPUT", "COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT")):
+            return
+        lines = text.splitlines(keepends=True)
+        if lines[0].strip() in ["MINI_SWE_AGENT_FINAL_OUTPUT", "COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT"]:
             submission = "".join(lines[1:])
             if self.config.validate_source_changes:
                 if not self._has_source_file_changes(submission):
@@ -137,25 +182,21 @@ class DefaultAgent:
                         + ") for the submission to be valid."
                     )
             raise Submitted(submission)
-    
+
     def _has_source_file_changes(self, git_diff_output: str) -> bool:
         """Check if git diff output contains changes to source files."""
-        changed_files = []
         for line in git_diff_output.splitlines():
             if line.startswith("diff --git"):
                 parts = line.split()
-                if len(parts) >= 3:
-                    filepath = parts[2].lstrip("a/").lstrip("b/")
-                    changed_files.append(filepath)
+                if len(parts) >= 3 and self._is_source_file(parts[2]):
+                    return True
             elif line.startswith("+++") or line.startswith("---"):
                 parts = line.split()
-                if len(parts) >= 2:
-                    filepath = parts[1].lstrip("a/").lstrip("b/")
-                    if filepath != "/dev/null":
-                        changed_files.append(filepath)
-        
-        for filepath in changed_files:
-            for pattern in self.config.source_path_patterns:
-                if fnmatch.fnmatch(filepath, pattern) or filepath.endswith(".py"):
+                if len(parts) >= 2 and parts[1] != "/dev/null" and self._is_source_file(parts[1]):
                     return True
-        return False
\ No newline at end of file
+        return False
+
+    def _is_source_file(self, diff_path: str) -> bool:
+        """Check a path from a diff header (with or without its a/ or b/ prefix) against the source patterns."""
+        filepath = diff_path[2:] if diff_path.startswith(("a/", "b/")) else diff_path
+        return any(r.match(filepath) for r in self._source_path_res)
@@ -1,6 +1,16 @@
 from __future__ import annotations
 
+import copy
+from collections.abc import Callable
 from dataclasses import dataclass
+from typing import Any
+
+# Retrieval scripts and their caches are run from and loaded out of this directory, so it must belong to the user
+# and be closed to everyone else. Shell syntax: the path is expanded inside the environment.
+SCRIPT_DIR = "/tmp/minisweagent-$(id -u)"
+PREPARE_SCRIPT_DIR_CMD = (
+    f'mkdir -p -m 700 "{SCRIPT_DIR}" && test ! -L "{SCRIPT_DIR}" && test -O "{SCRIPT_DIR}" && chmod 700 "{SCRIPT_DIR}"'
+)
 
 
 @dataclass(frozen=True)
@@ -57,21 +67,28 @@ def _hybrid_setup() -> RetrievalSetup:
     )
 
 
+_SETUPS: dict[str, Callable[[], RetrievalSetup]] = {
+    "none": _none_setup,
+    "": _none_setup,
+    "off": _none_setup,
+    "bm25": _bm25_setup,
+    "bm25_py": _bm25_py_setup,
+    "bm25_source": _bm25_source_setup,
+    "bm25_two_stage": _bm25_two_stage_setup,
+    "hybrid": _hybrid_setup,
+}
+
+_RUN_CFG_OVERRIDES: dict[str, dict[str, Any]] = {
+    "bm25": {"retrieval_index_all_files": True},
+    "bm25_py": {"retrieval_index_all_files": False, "retrieval_file_extensions": [".py"]},
+    "bm25_source": {"retrieval_index_all_files": False, "retrieval_file_extensions": [".py"]},
+    "bm25_two_stage": {"retrieval_index_all_files": False, "retrieval_file_extensions": [".py"]},
+    "hybrid": {"retrieval_index_all_files": True},
+}
+
+
 def get_retrieval_setup(strategy: str) -> RetrievalSetup:
-    s = strategy.lower().strip()
-    if s in ("none", "", "off"):
-        return _none_setup()
-    if s == "bm25":
-        return _bm25_setup()
-    if s == "bm25_py":
-        return _bm25_py_setup()
-    if s == "bm25_source":
-        return _bm25_source_setup()
-    if s == "bm25_two_stage":
-        return _bm25_two_stage_setup()
-    if s == "hybrid":
-        return _hybrid_setup()
-    return _none_setup()
+    return _SETUPS.get(strategy.lower().strip(), _none_setup)()
 
 
 def apply_retrieval_to_config(config: dict, strategy: str) -> dict:
@@ -83,19 +100,6 @@ def apply_retrieval_to_config(config: dict, strategy: str) -> dict:
             agent_cfg["system_template"] = (base + "\n\n" + setup.system_guidelines).strip()
     run_cfg = config.setdefault("run", {})
     run_cfg["retrieval_strategy"] = strategy
-    s = strategy.lower().strip()
-    if s == "bm25":
-        run_cfg["retrieval_index_all_files"] = True
-    elif s == "bm25_py":
-        run_cfg["retrieval_index_all_files"] = False
-        run_cfg["retrieval_file_extensions"] = [".py"]
-    elif s == "bm25_source":
-        run_cfg["retrieval_index_all_files"] = False
-        run_cfg["retrieval_file_extensions"] = [".py"]
-    elif s == "bm25_two_stage":
-        run_cfg["retrieval_index_all_files"] = False
-        run_cfg["retrieval_file_extensions"] = [".py"]
-    elif s == "hybrid":
-        run_cfg["retrieval_index_all_files"] = True
+    run_cfg.update(copy.deepcopy(_RUN_CFG_OVERRIDES.get(strategy.lower().strip(), {})))
     return config
 
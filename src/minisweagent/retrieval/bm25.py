@@ -1,112 +1,178 @@
+import base64
+import hashlib
 import json
-import re
-from pathlib import Path
+import weakref
 from typing import Any
 
+from minisweagent.retrieval import PREPARE_SCRIPT_DIR_CMD, SCRIPT_DIR
+
 MAX_FILE_SIZE = 500_000
 DEFAULT_TOP_K = 10
 MAX_HELPER_FILES = 5
+# The script uses scipy when the environment already has it, but never installs it into the repo under test
+INSTALL_CMD = (
+    'python3 -c "import rank_bm25" 2>/dev/null || '
+    "(apt-get update -y >/dev/null 2>&1 && apt-get install -y python3-pip >/dev/null 2>&1 "
+    "&& python3 -m pip install -U rank-bm25 >/dev/null 2>&1)"
+)
 
-
-def run_retrieval_in_container(
-    env: Any, 
-    task: str, 
-    strategy: str, 
-    top_k: int = DEFAULT_TOP_K, 
-    file_extensions: list[str] | None = None,
-    index_all_files: bool = False,
-    filter_pattern: str | None = None,
-    source_path_prefix: str | None = None,
-    entity_name: str | None = None,
-) -> list[str]:
-    install_cmd = "apt-get update -y >/dev/null 2>&1 && apt-get install -y python3-pip >/dev/null 2>&1 && python3 -m pip install -U rank-bm25 >/dev/null 2>&1 || true"
-    env.execute(install_cmd)
-    
-    task_escaped = task.replace('"', '\\"').replace("$", "\\$")
-    extensions_str = json.dumps(file_extensions if file_extensions is not None else [".py"])
-    filter_pattern_escaped = (filter_pattern.replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$") if filter_pattern else "")
-    source_path_prefix_escaped = (source_path_prefix.replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$") if source_path_prefix else "")
-    entity_name_escaped = (entity_name.replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$") if entity_name else "")
-    
-    retrieval_script = rf'''python3 <<'BM25_EOF'
+# Runs inside the environment. Parameters are passed as base64-encoded JSON in argv[1].
+RETRIEVAL_SCRIPT = r'''import base64
+import hashlib
 import json
+import os
+import pickle
 import re
-from pathlib import Path
-
-MAX_FILE_SIZE = {MAX_FILE_SIZE}
-MAX_HELPER_FILES = {MAX_HELPER_FILES}
+import stat
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from rank_bm25 import BM25Okapi
+    import numpy as np
+    try:
+        from scipy.sparse import csr_matrix
+        BM25Okapi = None
+    except ImportError:
+        from rank_bm25 import BM25Okapi
 except ImportError:
     print(json.dumps([]))
     exit(0)
 
-task = """{task_escaped}"""
-repo_path = Path("/testbed")
-strategy = "{strategy}"
-top_k = {top_k}
-file_extensions = {extensions_str}
-index_all_files = {str(index_all_files).lower()}
-source_path_prefix = """{source_path_prefix_escaped}""" if """{source_path_prefix_escaped}""" else None
-entity_name = """{entity_name_escaped}""" if """{entity_name_escaped}""" else None
-
-if index_all_files:
-    code_files = [f for f in repo_path.rglob("*") if f.is_file()]
-else:
-    code_files = []
-    for ext in file_extensions:
-        pattern = "*" + ext if ext.startswith(".") else "*." + ext
-        code_files.extend(list(repo_path.rglob(pattern)))
+class SparseBM25:
+    """Scores like rank_bm25.BM25Okapi, but with one sparse matrix product per query."""
+
+    def __init__(self, corpus, k1=1.5, b=0.75, epsilon=0.25):
+        self.vocabulary = {}
+        indptr, indices, data = [0], [], []
+        for tokens in corpus:
+            counts = Counter(tokens)
+            indices.extend(self.vocabulary.setdefault(token, len(self.vocabulary)) for token in counts)
+            data.extend(counts.values())
+            indptr.append(len(indices))
+        tf = csr_matrix((np.array(data, dtype=np.float64), indices, indptr), shape=(len(corpus), len(self.vocabulary)))
+        doc_len = np.asarray(tf.sum(axis=1)).ravel()
+        doc_freq = np.bincount(tf.indices, minlength=tf.shape[1])
+        idf = np.log(len(corpus) - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        idf[idf < 0] = epsilon * idf.mean()
+        norm = k1 * (1 - b + b * doc_len / doc_len.mean())
+        rows = np.repeat(np.arange(len(corpus)), np.diff(tf.indptr))
+        tf.data = idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + norm[rows])
+        self.weights = tf.tocsc()
+
+    def get_scores(self, query):
+        cols = [self.vocabulary[token] for token in query if token in self.vocabulary]
+        if not cols:
+            return np.zeros(self.weights.shape[0])
+        return np.asarray(self.weights[:, cols].sum(axis=1)).ravel()
+
+params = json.loads(base64.b64decode(sys.argv[1]))
+task = params["task"]
+repo_root = "/testbed"
+strategy = params["strategy"]
+top_k = params["top_k"]
+file_extensions = params["file_extensions"]
+index_all_files = params["index_all_files"]
+source_path_prefix = params["source_path_prefix"]
+filter_pattern = params["filter_pattern"]
+entity_name = params["entity_name"]
+max_file_size = params["max_file_size"]
+
+extensions = tuple(ext if ext.startswith(".") else "." + ext for ext in file_extensions)
+code_files = []
+for dirpath, _, filenames in os.walk(repo_root):
+    for filename in filenames:
+        if index_all_files or filename.endswith(extensions):
+            code_files.append(os.path.join(dirpath, filename))
+rel_start = len(repo_root) + 1
 filtered_files = code_files
 if source_path_prefix:
-    filtered_files = [f for f in filtered_files if str(f.relative_to(repo_path)).startswith(source_path_prefix + "/") or str(f.relative_to(repo_path)) == source_path_prefix]
-filter_pattern = """{filter_pattern_escaped}"""
+    filtered_files = [f for f in filtered_files if f[rel_start:].startswith(source_path_prefix + "/") or f[rel_start:] == source_path_prefix]
 if filter_pattern:
-    filtered_files = [f for f in filtered_files if re.search(filter_pattern, str(f))]
+    filter_re = re.compile(filter_pattern)
+    filtered_files = [f for f in filtered_files if filter_re.search(f)]
 
 if not filtered_files:
     print(json.dumps([]))
     exit(0)
 
-file_contents = []
-valid_files = []
+def read_file(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+# The index only depends on the files and their stat info, so it is cached across calls on the same tree
+state = hashlib.blake2b(str(BM25Okapi is None).encode(), digest_size=16)
+indexable_files = []
 for file_path in filtered_files:
-    content = file_path.read_text(errors="ignore")
-    if len(content) > MAX_FILE_SIZE:
+    try:
+        st = os.stat(file_path)
+    except OSError:
         continue
-    file_contents.append(content)
-    valid_files.append(str(file_path.relative_to(repo_path)))
+    if stat.S_ISREG(st.st_mode) and st.st_size <= max_file_size:
+        indexable_files.append(file_path)
+        state.update(f"{file_path}\0{st.st_mtime_ns}\0{st.st_size}\n".encode())
+cache_dir = os.path.splitext(os.path.abspath(__file__))[0] + "_cache"
+cache_file = os.path.join(cache_dir, state.hexdigest() + ".pkl")
 
-if not file_contents:
-    print(json.dumps([]))
-    exit(0)
+try:
+    with open(cache_file, "rb") as f:
+        bm25, valid_files = pickle.load(f)
+except Exception:
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        contents = list(executor.map(read_file, indexable_files))
+    file_contents = []
+    valid_files = []
+    for file_path, content in zip(indexable_files, contents):
+        if content is None:
+            continue
+        file_contents.append(content)
+        valid_files.append(file_path[rel_start:])
+    if not file_contents:
+        print(json.dumps([]))
+        exit(0)
+    tokenized_docs = [doc.lower().split() for doc in file_contents]
+    bm25 = SparseBM25(tokenized_docs) if BM25Okapi is None else BM25Okapi(tokenized_docs)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{cache_file}.{os.getpid()}", "wb") as f:
+            pickle.dump((bm25, valid_files), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{cache_file}.{os.getpid()}", cache_file)
+        # Every edit to the tree produces a new key, so only the newest index is kept
+        for name in os.listdir(cache_dir):
+            if name.endswith(".pkl") and name != os.path.basename(cache_file):
+                os.remove(os.path.join(cache_dir, name))
+    except OSError:
+        pass
 
-tokenized_docs = [doc.lower().split() for doc in file_contents]
-bm25 = BM25Okapi(tokenized_docs)
-query = task.lower().split()
-scores = bm25.get_scores(query)
+def top_k_indices(scores, k):
+    # Same order as a stable descending sort: ties go to the lower index, whichever side of the cut they fall on
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")[:k].tolist()
+    threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+    candidates = np.flatnonzero(scores >= threshold)
+    return candidates[np.argsort(-scores[candidates], kind="stable")][:k].tolist()
+
+query = task.encode().lower().split()
+scores = np.asarray(bm25.get_scores(query))
 
 two_stage = strategy == "bm25_two_stage"
 if two_stage:
     candidate_top_k = 20
-    top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:candidate_top_k]
+    top_indices = top_k_indices(scores, candidate_top_k)
     candidate_files = [(valid_files[i], scores[i]) for i in top_indices if scores[i] > 0]
     if entity_name and candidate_files:
         reranked_files = []
-        entity_pattern = re.escape(entity_name)
+        entity_pattern = re.escape(entity_name.encode())
+        definition_re = re.compile(
+            rb"^\s*(?:class\s+" + entity_pattern + rb"\s*[:\(]|def\s+" + entity_pattern + rb"\s*\()", re.MULTILINE
+        )
         for file_path, bm25_score in candidate_files:
-            file_content = None
-            for i, vf in enumerate(valid_files):
-                if vf == file_path:
-                    file_content = file_contents[i]
-                    break
+            file_content = read_file(os.path.join(repo_root, file_path))
             if file_content:
-                score_boost = 0
-                if re.search(rf"^\s*class\s+{{entity_pattern}}\s*[:\(]", file_content, re.MULTILINE):
-                    score_boost = 100
-                elif re.search(rf"^\s*def\s+{{entity_pattern}}\s*\(", file_content, re.MULTILINE):
-                    score_boost = 100
+                score_boost = 100 if definition_re.search(file_content) else 0
                 reranked_files.append((file_path, bm25_score + score_boost))
             else:
                 reranked_files.append((file_path, bm25_score))
@@ -116,14 +182,62 @@ if two_stage:
         retrieved_files = [f for f, _ in candidate_files[:3]]
     print(json.dumps(retrieved_files))
 else:
-    top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
+    top_indices = top_k_indices(scores, top_k)
     retrieved_files = [valid_files[i] for i in top_indices if scores[i] > 0]
     print(json.dumps(retrieved_files))
-BM25_EOF'''
-    
-    result = env.execute(retrieval_script)
+'''
+SCRIPT_PATH = f"{SCRIPT_DIR}/bm25_{hashlib.sha1(RETRIEVAL_SCRIPT.encode()).hexdigest()[:12]}.py"
+
+_prepared_envs: weakref.WeakSet = weakref.WeakSet()
+
+
+def _prepare_env(env: Any) -> bool:
+    """Install the retrieval dependencies and write the script unless this was already done for the environment.
+    Returns whether the script is in place; an existing file is not trusted but overwritten once per environment.
+    """
+    if env in _prepared_envs:
+        return True
+    install = env.execute(INSTALL_CMD)
+    write_script = env.execute(
+        f'{PREPARE_SCRIPT_DIR_CMD} && cat > "{SCRIPT_PATH}.$$" <<\'BM25_EOF\' && mv "{SCRIPT_PATH}.$$" "{SCRIPT_PATH}"\n'
+        f"{RETRIEVAL_SCRIPT}BM25_EOF"
+    )
+    if write_script.get("returncode") != 0:
+        return False
+    if install.get("returncode") == 0:
+        _prepared_envs.add(env)
+    return True
+
+
+def run_retrieval_in_container(
+    env: Any,
+    task: str,
+    strategy: str,
+    top_k: int = DEFAULT_TOP_K,
+    file_extensions: list[str] | None = None,
+    index_all_files: bool = False,
+    filter_pattern: str | None = None,
+    source_path_prefix: str | None = None,
+    entity_name: str | None = None,
+) -> list[str]:
+    if not _prepare_env(env):
+        return []
+    params = {
+        "task": task,
+        "strategy": strategy,
+        "top_k": top_k,
+        "file_extensions": file_extensions if file_extensions is not None else [".py"],
+        "index_all_files": index_all_files,
+        "filter_pattern": filter_pattern,
+        "source_path_prefix": source_path_prefix,
+        "entity_name": entity_name,
+        "max_file_size": MAX_FILE_SIZE,
+    }
+    encoded_params = base64.b64encode(json.dumps(params).encode()).decode()
+    # Environments merge stderr into the output, so warnings are dropped and only the last line is the result
+    result = env.execute(f'python3 "{SCRIPT_PATH}" {encoded_params} 2>/dev/null')
     try:
-        files = json.loads(result["output"].strip())
+        files = json.loads(result["output"].strip().rsplit("\n", 1)[-1])
         return files if isinstance(files, list) else []
     except (json.JSONDecodeError, ValueError):
         return []
@@ -1,8 +1,10 @@
+import base64
+import hashlib
 import json
-import re
-from pathlib import Path
+import weakref
 from typing import Any
 
+from minisweagent.retrieval import PREPARE_SCRIPT_DIR_CMD, SCRIPT_DIR
 
 MAX_FILE_SIZE = 500_000
 DEFAULT_TOP_K = 10
@@ -10,99 +12,110 @@ DEFAULT_CHUNK_SIZE = 512
 DEFAULT_CHUNK_OVERLAP = 50
 DEFAULT_EMBEDDING_WEIGHT = 0.7
 DEFAULT_BM25_WEIGHT = 0.3
+INSTALL_CMD = (
+    'python3 -c "import bm25s, optimum.onnxruntime, sentence_transformers" 2>/dev/null || '
+    "(apt-get update -y >/dev/null 2>&1 && apt-get install -y python3-pip >/dev/null 2>&1 "
+    "&& python3 -m pip install -U bm25s 'sentence-transformers[onnx]' faiss-cpu >/dev/null 2>&1)"
+)
 
-
-def chunk_text(text: str, chunk_size: int, overlap: int) -> list[tuple[str, int, int]]:
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunk_text_slice = text[start:end]
-        chunks.append((chunk_text_slice, start, end))
-        start += chunk_size - overlap
-        if start >= len(text):
-            break
-    return chunks
-
-
-def run_retrieval_in_container(
-    env: Any,
-    task: str,
-    strategy: str,
-    top_k: int = DEFAULT_TOP_K,
-    file_extensions: list[str] | None = None,
-    index_all_files: bool = False,
-    filter_pattern: str | None = None,
-    source_path_prefix: str | None = None,
-    chunk_size: int = DEFAULT_CHUNK_SIZE,
-    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
-    embedding_weight: float = DEFAULT_EMBEDDING_WEIGHT,
-    bm25_weight: float = DEFAULT_BM25_WEIGHT,
-    embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
-) -> list[dict[str, Any]]:
-    install_cmd = "apt-get update -y >/dev/null 2>&1 && apt-get install -y python3-pip >/dev/null 2>&1 && python3 -m pip install -U rank-bm25 sentence-transformers faiss-cpu >/dev/null 2>&1 || true"
-    env.execute(install_cmd)
-    
-    task_escaped = task.replace('"', '\\"').replace("$", "\\$").replace("\n", "\\n")
-    extensions_str = json.dumps(file_extensions if file_extensions is not None else [".py"])
-    filter_pattern_escaped = (filter_pattern.replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$") if filter_pattern else "")
-    source_path_prefix_escaped = (source_path_prefix.replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$") if source_path_prefix else "")
-    embedding_model_escaped = embedding_model.replace('"', '\\"').replace("$", "\\$")
-    
-    retrieval_script = rf'''python3 <<'HYBRID_EOF'
+# Runs inside the environment. Parameters are passed as base64-encoded JSON in argv[1].
+RETRIEVAL_SCRIPT = r"""import base64
+import hashlib
 import json
+import os
+import pickle
 import re
-from pathlib import Path
-
-MAX_FILE_SIZE = {MAX_FILE_SIZE}
-CHUNK_SIZE = {chunk_size}
-CHUNK_OVERLAP = {chunk_overlap}
-EMBEDDING_WEIGHT = {embedding_weight}
-BM25_WEIGHT = {bm25_weight}
-TOP_K = {top_k}
-
-def chunk_text(text, chunk_size, overlap):
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunk_text_slice = text[start:end]
-        chunks.append((chunk_text_slice, start, end))
-        start += chunk_size - overlap
-        if start >= len(text):
-            break
-    return chunks
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_DIR = os.path.splitext(os.path.abspath(__file__))[0] + "_cache"
+# Tokenizer for the rank_bm25 fallback; bm25s has its own
+WORD_RE = re.compile(r"\w+")
+
+def chunk_offsets(text_length, chunk_size, overlap):
+    return [(start, min(start + chunk_size, text_length)) for start in range(0, text_length, chunk_size - overlap)]
 
 try:
-    from rank_bm25 import BM25Okapi
+    import torch
     from sentence_transformers import SentenceTransformer
-    import faiss
     import numpy as np
+    try:
+        import bm25s
+        BM25Okapi = None
+    except ImportError:
+        from rank_bm25 import BM25Okapi
 except ImportError:
     print(json.dumps([]))
     exit(0)
 
-task = """{task_escaped}"""
-repo_path = Path("/testbed")
-file_extensions = {extensions_str}
-index_all_files = {str(index_all_files).lower()}
-source_path_prefix = """{source_path_prefix_escaped}""" if """{source_path_prefix_escaped}""" else None
-embedding_model_name = """{embedding_model_escaped}"""
+def available_cpus():
+    # os.cpu_count() ignores the affinity mask and cgroup quota that parallel workers run under
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            n = min(n, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return n
 
-if index_all_files:
-    code_files = [f for f in repo_path.rglob("*") if f.is_file()]
-else:
-    code_files = []
-    for ext in file_extensions:
-        pattern = "*" + ext if ext.startswith(".") else "*." + ext
-        code_files.extend(list(repo_path.rglob(pattern)))
-
-filtered_files = code_files
-if source_path_prefix:
-    filtered_files = [f for f in filtered_files if str(f.relative_to(repo_path)).startswith(source_path_prefix + "/") or str(f.relative_to(repo_path)) == source_path_prefix]
-filter_pattern = """{filter_pattern_escaped}"""
-if filter_pattern:
-    filtered_files = [f for f in filtered_files if re.search(filter_pattern, str(f))]
+# An explicit OMP_NUM_THREADS is left alone; torch already reads it
+try:
+    n_threads = max(1, int(os.environ["OMP_NUM_THREADS"]))
+except (KeyError, ValueError):
+    n_threads = available_cpus()
+    torch.set_num_threads(n_threads)
+torch.set_num_interop_threads(max(1, n_threads // 2))
+
+params = json.loads(base64.b64decode(sys.argv[1]))
+tasks = params["tasks"]
+repo_root = "/testbed"
+file_extensions = params["file_extensions"]
+index_all_files = params["index_all_files"]
+source_path_prefix = params["source_path_prefix"]
+filter_pattern = params["filter_pattern"]
+embedding_model_name = params["embedding_model"]
+MAX_FILE_SIZE = params["max_file_size"]
+CHUNK_SIZE = params["chunk_size"]
+CHUNK_OVERLAP = params["chunk_overlap"]
+EMBEDDING_WEIGHT = params["embedding_weight"]
+BM25_WEIGHT = params["bm25_weight"]
+TOP_K = params["top_k"]
+
+def iter_files(path):
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Like os.walk, symlinked directories are not descended into, but symlinked files are indexed
+                if entry.is_dir(follow_symlinks=False):
+                    yield from iter_files(entry.path)
+                elif entry.is_file():
+                    yield entry
+    except OSError:
+        return
+
+extensions = tuple(ext if ext.startswith(".") else "." + ext for ext in file_extensions)
+prefix_path = repo_root + "/" + source_path_prefix if source_path_prefix else None
+filter_search = re.compile(filter_pattern).search if filter_pattern else None
+filtered_files = []
+for entry in iter_files(repo_root):
+    path = entry.path
+    if not index_all_files and not entry.name.endswith(extensions):
+        continue
+    if prefix_path and not (path.startswith(prefix_path + "/") or path == prefix_path):
+        continue
+    if filter_search and not filter_search(path):
+        continue
+    try:
+        st = entry.stat()
+    except OSError:
+        continue
+    if st.st_size <= MAX_FILE_SIZE:
+        filtered_files.append((path, st))
 
 if not filtered_files:
     print(json.dumps([]))
@@ -110,64 +123,288 @@ if not filtered_files:
 
 all_chunks = []
 chunk_metadata = []
-for file_path in filtered_files:
+# (cache key, first chunk, end chunk) per file; embeddings only depend on what goes into the key
+file_spans = []
+rel_start = len(repo_root) + 1
+
+def read_and_chunk(file_path):
     try:
-        content = file_path.read_text(errors="ignore")
-        if len(content) > MAX_FILE_SIZE:
+        with open(file_path, "rb") as f:
+            content = f.read().decode("utf-8", errors="ignore")
+    except OSError:
+        return None
+    offsets = chunk_offsets(len(content), CHUNK_SIZE, CHUNK_OVERLAP)
+    return [content[start:end] for start, end in offsets], offsets
+
+with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+    # map() keeps the file order, so chunk indices are the same from run to run
+    for (file_path, st), result in zip(filtered_files, executor.map(read_and_chunk, [f for f, _ in filtered_files])):
+        if not result or not result[1]:
             continue
-        file_rel_path = str(file_path.relative_to(repo_path))
-        chunks = chunk_text(content, CHUNK_SIZE, CHUNK_OVERLAP)
-        for chunk_text_slice, start, end in chunks:
-            all_chunks.append(chunk_text_slice)
-            chunk_metadata.append(dict(path=file_rel_path, start=start, end=end))
-    except Exception:
-        continue
+        chunks, offsets = result
+        file_rel_path = file_path[rel_start:]
+        cache_key = hashlib.sha1(
+            f"{file_rel_path}|{st.st_size}|{st.st_mtime_ns}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{embedding_model_name}".encode()
+        ).hexdigest()
+        file_spans.append((cache_key, len(all_chunks), len(all_chunks) + len(chunks)))
+        all_chunks.extend(chunks)
+        chunk_metadata.extend(dict(path=file_rel_path, start=start, end=end) for start, end in offsets)
 
 if not all_chunks:
     print(json.dumps([]))
     exit(0)
 
-model = SentenceTransformer(embedding_model_name)
-task_embedding = model.encode([task])[0]
-chunk_embeddings = model.encode(all_chunks)
-
-dimension = chunk_embeddings.shape[1]
-index = faiss.IndexFlatIP(dimension)
-chunk_embeddings_normalized = chunk_embeddings / np.linalg.norm(chunk_embeddings, axis=1, keepdims=True)
-task_embedding_normalized = task_embedding / np.linalg.norm(task_embedding)
-index.add(chunk_embeddings_normalized.astype('float32'))
-
-scores_embedding, indices_embedding = index.search(np.expand_dims(task_embedding_normalized.astype('float32'), 0), min(TOP_K * 2, len(all_chunks)))
-
-tokenized_chunks = [chunk.lower().split() for chunk in all_chunks]
-bm25 = BM25Okapi(tokenized_chunks)
-query_tokens = task.lower().split()
-scores_bm25 = bm25.get_scores(query_tokens)
-
-normalized_scores_bm25 = (scores_bm25 - scores_bm25.min()) / (scores_bm25.max() - scores_bm25.min() + 1e-10)
-
-hybrid_scores = {{}}
-for i, (score_emb, idx) in enumerate(zip(scores_embedding[0], indices_embedding[0])):
-    score_bm25 = normalized_scores_bm25[idx]
-    hybrid_score = EMBEDDING_WEIGHT * float(score_emb) + BM25_WEIGHT * float(score_bm25)
-    hybrid_scores[idx] = hybrid_score
-
-all_indices_with_scores = [(idx, score) for idx, score in hybrid_scores.items() if score > 0]
-all_indices_with_scores.sort(key=lambda x: x[1], reverse=True)
-top_indices = [idx for idx, _ in all_indices_with_scores[:TOP_K]]
-
-retrieved_chunks = []
-for idx in top_indices:
-    metadata = chunk_metadata[idx].copy()
-    metadata["content"] = all_chunks[idx]
-    retrieved_chunks.append(metadata)
-
-print(json.dumps(retrieved_chunks))
-HYBRID_EOF'''
-    
-    result = env.execute(retrieval_script)
+def save_cached(path, write):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(f"{path}.{os.getpid()}", "wb") as f:
+            write(f)
+        os.replace(f"{path}.{os.getpid()}", path)
+    except OSError:
+        pass
+
+bm25_state = hashlib.sha1(str(BM25Okapi is None).encode())
+for cache_key, _, _ in file_spans:
+    bm25_state.update(cache_key.encode())
+bm25_cache_file = os.path.join(CACHE_DIR, "bm25_" + bm25_state.hexdigest() + ".pkl")
+
+def load_or_build_bm25():
+    try:
+        with open(bm25_cache_file, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        pass
+    if BM25Okapi is None:
+        bm25 = bm25s.BM25()
+        bm25.index(bm25s.tokenize(all_chunks, stopwords="en", show_progress=False), show_progress=False)
+    else:
+        bm25 = BM25Okapi([WORD_RE.findall(chunk.lower()) for chunk in all_chunks])
+    save_cached(bm25_cache_file, lambda f: pickle.dump(bm25, f, protocol=pickle.HIGHEST_PROTOCOL))
+    return bm25
+
+# The BM25 index does not depend on the embeddings, so it is built while the model loads and encodes
+bm25_future = ThreadPoolExecutor(max_workers=1).submit(load_or_build_bm25)
+
+QINT8_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+def has_qint8_onnx(model_name):
+    # sentence-transformers silently exports an fp32 ONNX model when the file is missing, so check up front
+    if os.path.isdir(model_name):
+        return os.path.isfile(os.path.join(model_name, QINT8_ONNX_FILE))
+    # The hub answer does not change, so it is remembered instead of paying a request (and its retries) every run
+    marker_file = os.path.join(CACHE_DIR, "qint8_onnx_" + hashlib.sha1(model_name.encode()).hexdigest())
+    try:
+        with open(marker_file, "rb") as f:
+            return f.read() == b"1"
+    except OSError:
+        pass
+    try:
+        from huggingface_hub import constants, file_exists, try_to_load_from_cache
+
+        if isinstance(try_to_load_from_cache(model_name, QINT8_ONNX_FILE), str):
+            found = True
+        elif constants.HF_HUB_OFFLINE or isinstance(try_to_load_from_cache(model_name, "config.json"), str):
+            # Only ask the hub for models that are not downloaded yet; an offline or unreachable hub costs retries
+            found = False
+        else:
+            found = file_exists(model_name, QINT8_ONNX_FILE)
+    except Exception:
+        found = False
+    save_cached(marker_file, lambda f: f.write(b"1" if found else b"0"))
+    return found
+
+model = None
+if has_qint8_onnx(embedding_model_name):
+    try:
+        import onnxruntime
+
+        # onnxruntime does not follow the torch thread settings
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = n_threads
+        # int8 ONNX export published with the model; several times faster than the fp32 PyTorch backbone on CPU
+        model = SentenceTransformer(
+            embedding_model_name,
+            backend="onnx",
+            model_kwargs={"file_name": os.path.basename(QINT8_ONNX_FILE), "session_options": session_options},
+        )
+        embedding_backend = "onnx_qint8"
+    except Exception:
+        pass
+if model is None:
+    model = SentenceTransformer(embedding_model_name)
+    embedding_backend = "torch"
+task_embeddings = model.encode(tasks, convert_to_numpy=True, normalize_embeddings=True).astype(np.float32, copy=False)
+dimension = task_embeddings.shape[1]
+
+chunk_embeddings = np.empty((len(all_chunks), dimension), dtype=np.float32)
+missing_spans = []
+for cache_key, first, end in file_spans:
+    try:
+        cached = np.load(os.path.join(CACHE_DIR, f"{cache_key}_{embedding_backend}.npy"))
+        if cached.shape != (end - first, dimension):
+            raise ValueError(cached.shape)
+        chunk_embeddings[first:end] = cached
+    except Exception:
+        missing_spans.append((cache_key, first, end))
+if missing_spans:
+    # encode() already sorts inputs by length internally, so each batch is only padded to similar lengths
+    missing_embeddings = model.encode(
+        [chunk for _, first, end in missing_spans for chunk in all_chunks[first:end]],
+        batch_size=64, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True,
+    ).astype(np.float32, copy=False)
+    offset = 0
+    for cache_key, first, end in missing_spans:
+        file_embeddings = missing_embeddings[offset:offset + end - first]
+        offset += end - first
+        chunk_embeddings[first:end] = file_embeddings
+        save_cached(
+            os.path.join(CACHE_DIR, f"{cache_key}_{embedding_backend}.npy"), lambda f: np.save(f, file_embeddings)
+        )
+
+num_candidates = min(TOP_K * 2, len(all_chunks))
+faiss = None
+if len(all_chunks) >= 50_000:
+    try:
+        import faiss
+    except ImportError:
+        pass
+if faiss is None:
+    # Exact search is one matrix product over all tasks; below 50k chunks an index costs more to build than it saves,
+    # and it also covers larger corpora when faiss is not installed
+    similarities = task_embeddings @ chunk_embeddings.T
+    top = np.argpartition(-similarities, num_candidates - 1, axis=1)[:, :num_candidates]
+    top_scores = np.take_along_axis(similarities, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    indices_embedding = np.take_along_axis(top, order, axis=1)
+    scores_embedding = np.take_along_axis(top_scores, order, axis=1)
+else:
+    # fp16 storage halves the memory the graph search has to touch, at negligible recall cost for cosine top-k
+    faiss.omp_set_num_threads(n_threads)
+    index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_fp16, 32, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = 40
+    index.hnsw.efSearch = max(32, TOP_K * 4)
+    index.train(chunk_embeddings)
+    index.add(chunk_embeddings)
+    # All tasks are searched in one call so FAISS can batch the query vectors
+    scores_embedding, indices_embedding = index.search(task_embeddings, num_candidates)
+
+bm25 = bm25_future.result()
+
+# Cache keys change with every edit to a file, so embeddings and indexes the current tree no longer uses are dropped
+keep = {os.path.basename(bm25_cache_file)} | {f"{cache_key}_{embedding_backend}.npy" for cache_key, _, _ in file_spans}
+try:
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith((".npy", ".pkl")) and name not in keep:
+            os.remove(os.path.join(CACHE_DIR, name))
+except OSError:
+    pass
+
+def bm25_scores(task):
+    if BM25Okapi is None:
+        query_tokens = bm25s.tokenize(task, stopwords="en", return_ids=False, show_progress=False)[0]
+        return bm25.get_scores(query_tokens) if query_tokens else np.zeros(len(all_chunks))
+    return bm25.get_scores(WORD_RE.findall(task.lower()))
+
+def top_k_indices(scores, k):
+    # Same order as a stable descending sort: ties go to the lower index, whichever side of the cut they fall on
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")[:k]
+    threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+    candidates = np.flatnonzero(scores >= threshold)
+    return candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+
+results = []
+for task, task_scores, task_indices in zip(tasks, scores_embedding, indices_embedding):
+    scores_bm25 = bm25_scores(task)
+    bm25_min, bm25_max = scores_bm25.min(), scores_bm25.max()
+    valid = task_indices >= 0
+    candidate_indices = task_indices[valid]
+    # Min-max normalize only the candidates' BM25 scores instead of the whole array
+    normalized_scores_bm25 = (scores_bm25[candidate_indices] - bm25_min) / (bm25_max - bm25_min + 1e-10)
+    hybrid_scores = EMBEDDING_WEIGHT * task_scores[valid].astype(np.float64) + BM25_WEIGHT * normalized_scores_bm25
+    positive = hybrid_scores > 0
+    candidate_indices = candidate_indices[positive]
+    hybrid_scores = hybrid_scores[positive]
+    top_indices = candidate_indices[top_k_indices(hybrid_scores, TOP_K)].tolist() if len(hybrid_scores) else []
+    results.append([dict(chunk_metadata[idx], content=all_chunks[idx]) for idx in top_indices])
+
+print(json.dumps(results))
+"""
+SCRIPT_PATH = f"{SCRIPT_DIR}/hybrid_{hashlib.sha1(RETRIEVAL_SCRIPT.encode()).hexdigest()[:12]}.py"
+# The script runs as __main__, which never uses cached bytecode, so it is compiled once and the .pyc is run directly
+COMPILED_SCRIPT_PATH = SCRIPT_PATH + "c"
+
+_prepared_envs: weakref.WeakSet = weakref.WeakSet()
+
+
+def chunk_offsets(text_length: int, chunk_size: int, overlap: int) -> list[tuple[int, int]]:
+    return [(start, min(start + chunk_size, text_length)) for start in range(0, text_length, chunk_size - overlap)]
+
+
+def chunk_text(text: str, chunk_size: int, overlap: int) -> list[tuple[str, int, int]]:
+    return [(text[start:end], start, end) for start, end in chunk_offsets(len(text), chunk_size, overlap)]
+
+
+def _prepare_env(env: Any) -> bool:
+    """Install the retrieval dependencies and compiled script unless this was already done for the environment.
+    Returns whether the script is in place; existing files are not trusted but overwritten once per environment.
+    """
+    if env in _prepared_envs:
+        return True
+    install = env.execute(INSTALL_CMD)
+    write_script = env.execute(
+        f"{PREPARE_SCRIPT_DIR_CMD} && cat > \"{SCRIPT_PATH}.$$\" <<'HYBRID_EOF' "
+        f'&& mv "{SCRIPT_PATH}.$$" "{SCRIPT_PATH}" '
+        "&& python3 -c 'import py_compile, sys; py_compile.compile(sys.argv[1], cfile=sys.argv[2], doraise=True)' "
+        f'"{SCRIPT_PATH}" "{COMPILED_SCRIPT_PATH}"\n{RETRIEVAL_SCRIPT}HYBRID_EOF'
+    )
+    if write_script.get("returncode") != 0:
+        return False
+    if install.get("returncode") == 0:
+        _prepared_envs.add(env)
+    return True
+
+
+def run_retrieval_in_container(
+    env: Any,
+    task: str | list[str],
+    strategy: str,
+    top_k: int = DEFAULT_TOP_K,
+    file_extensions: list[str] | None = None,
+    index_all_files: bool = False,
+    filter_pattern: str | None = None,
+    source_path_prefix: str | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+    embedding_weight: float = DEFAULT_EMBEDDING_WEIGHT,
+    bm25_weight: float = DEFAULT_BM25_WEIGHT,
+    embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+) -> list[dict[str, Any]] | list[list[dict[str, Any]]]:
+    """Retrieve chunks for a task, or one list of chunks per task when given several tasks for the same repo."""
+    tasks = [task] if isinstance(task, str) else list(task)
+    if not _prepare_env(env):
+        return [] if isinstance(task, str) else [[] for _ in tasks]
+    params = {
+        "tasks": tasks,
+        "top_k": top_k,
+        "file_extensions": file_extensions if file_extensions is not None else [".py"],
+        "index_all_files": index_all_files,
+        "filter_pattern": filter_pattern,
+        "source_path_prefix": source_path_prefix,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "embedding_weight": embedding_weight,
+        "bm25_weight": bm25_weight,
+        "embedding_model": embedding_model,
+        "max_file_size": MAX_FILE_SIZE,
+    }
+    encoded_params = base64.b64encode(json.dumps(params).encode()).decode()
+    # Model loading logs to stderr, which environments merge into the output, so only the last line is the result
+    result = env.execute(f'python3 "{COMPILED_SCRIPT_PATH}" {encoded_params} 2>/dev/null')
     try:
-        chunks = json.loads(result["output"].strip())
-        return chunks if isinstance(chunks, list) else []
+        results = json.loads(result["output"].strip().rsplit("\n", 1)[-1])
     except (json.JSONDecodeError, ValueError):
-        return []
+        results = None
+    if not isinstance(results, list) or len(results) != len(tasks):
+        results = [[] for _ in tasks]
+    return results[0] if isinstance(task, str) else results